@@ -18,6 +18,7 @@ from src.models import (
 )
 from src.services.credential_manager import CredentialManager
 from src.services.service_registry import ServiceRegistry
+from src.services.ai_router import ai_router
 from src.routes import services as services_routes
 from src.routes import credentials as credentials_routes
 from src.routes import gateway as gateway_routes
@@ -48,6 +49,7 @@ async def lifespan(app: FastAPI):
     health_monitor_task = asyncio.create_task(
         service_registry.periodic_health_check()
     )
+    ai_router.start()
     logger.info("✅ Zimmer-13 Coordinator started")
     
     yield
@@ -56,6 +58,7 @@ async def lifespan(app: FastAPI):
     logger.info("Shutting down Zimmer-13 API Coordinator...")
     if health_monitor_task:
         health_monitor_task.cancel()
+    await ai_router.aclose()
     logger.info("✅ Zimmer-13 Coordinator stopped")
 
 
@@ -4,16 +4,140 @@ Strategy: grok-code for TEXT, Gemini for VISION
 NO PAID SERVICES ALLOWED!
 """
 import httpx
+import orjson
 import asyncio
 import os
 import base64
-from typing import Optional, Literal, Dict, Any
+import contextlib
+import hashlib
+import random
+import re
+import statistics
+import time
+from collections import OrderedDict, deque
+from typing import Optional, Literal, Dict, Any, Deque, Tuple, Callable, Awaitable, AsyncIterator, Union, List
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field
 import logging
 
 logger = logging.getLogger(__name__)
 
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 529}
+MAX_RETRY_ATTEMPTS = 5
+MAX_RETRY_WAIT = 30.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_MAX_OPEN_SECONDS = 60
+RATE_WINDOW = timedelta(days=1)
+CACHE_MAXSIZE = 512
+CACHE_TTL_SECONDS = 300.0
+MAX_CONNECTIONS = 1000
+MAX_KEEPALIVE_CONNECTIONS = 100
+DEFAULT_BATCH_CONCURRENCY = 16
+# Most replies are far shorter; a tighter cap shortens worst-case generation time
+DEFAULT_MAX_TOKENS = 512
+METRICS_BUFFER_SIZE = 4096
+
+TEXT_PROVIDER_ORDER = ["opencode_zen", "mistral", "groq", "huggingface"]
+VISION_PROVIDER_ORDER = ["gemini", "groq"]
+# Text providers speaking the OpenAI chat-completions SSE stream format
+STREAMING_PROVIDERS = {"opencode_zen", "mistral", "groq"}
+EWMA_ALPHA = 0.1
+# Below this success rate a provider drops one priority tier
+EWMA_DEGRADED_SUCCESS = 0.5
+
+# Per-phase budgets set just above observed p95; a 3s connect fails dead hosts fast
+TEXT_TIMEOUT = httpx.Timeout(connect=3.0, read=45.0, write=10.0, pool=1.0)
+VISION_TIMEOUT = httpx.Timeout(connect=3.0, read=75.0, write=15.0, pool=1.0)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse rate-limit header durations: '30', '1.5', '2m59.56s', '120ms' or an epoch timestamp"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        parts = _DURATION_PART.findall(value)
+        if not parts:
+            return None
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(amount) * scale[unit] for amount, unit in parts)
+    # Some providers send an absolute epoch time instead of a delta
+    if seconds > 1_000_000_000:
+        return max(0.0, seconds - time.time())
+    return seconds
+
+
+IMAGE_PLACEHOLDER = "\x00image\x00"
+_IMAGE_PLACEHOLDER_JSON = orjson.dumps(IMAGE_PLACEHOLDER)[1:-1]
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+_ASCII_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+def _clean_base64(image: bytes) -> Optional[bytes]:
+    """Return image with ASCII whitespace (e.g. MIME line breaks) removed, or None if it isn't base64"""
+    leftover = image.translate(None, _B64_ALPHABET)
+    if not leftover:
+        return image
+    if leftover.translate(None, _ASCII_WHITESPACE):
+        return None
+    return image.translate(None, _ASCII_WHITESPACE)
+
+
+def _splice_image(payload: Dict[str, Any], image: bytes, prefix: bytes = b"") -> bytes:
+    """Serialize payload, then splice the base64 image in place of IMAGE_PLACEHOLDER.
+
+    image must already have passed _clean_base64: pure base64 alphabet never
+    needs JSON escaping, so the multi-MB image is copied once instead of being
+    scanned and re-encoded by the serializer.
+    """
+    head, _, tail = orjson.dumps(payload).rpartition(_IMAGE_PLACEHOLDER_JSON)
+    return b"".join((head, prefix, image, tail))
+
+
+def _is_provider_fault(exc: Exception) -> bool:
+    """Outages and throttling; a 400/401/413 or unparseable body is about the request, not the provider"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status_code = exc.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+@dataclass
+class ProviderEvent:
+    """One HTTP exchange with a provider, as recorded by the router's metrics hook"""
+    provider: str
+    status: Union[int, str]  # HTTP status code, or the exception name if no response arrived
+    elapsed: float
+    bytes_in: int
+    bytes_out: int
+    timestamp: datetime = field(default_factory=datetime.now)
+
+    @property
+    def success(self) -> bool:
+        return isinstance(self.status, int) and 200 <= self.status < 300
+
+
+@dataclass(frozen=True)
+class GenerationOptions:
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    json_mode: bool = False
+
+    def openai_fields(self) -> Dict[str, Any]:
+        """Per-call fields for OpenAI-compatible chat-completions bodies"""
+        if self.json_mode:
+            return {"max_tokens": self.max_tokens, "response_format": {"type": "json_object"}}
+        return {"max_tokens": self.max_tokens}
+
+    def gemini_generation_config(self) -> Dict[str, Any]:
+        config = {"temperature": 0.3, "maxOutputTokens": self.max_tokens}
+        if self.json_mode:
+            config["responseMimeType"] = "application/json"
+        return config
+
 
 @dataclass
 class ProviderConfig:
@@ -26,6 +150,22 @@ class ProviderConfig:
     rate_limit: Optional[int] = None
     requests_today: int = 0
     last_reset: datetime = field(default_factory=datetime.now)
+    # Sliding rate_limit window: one (minute, count) bucket per active minute
+    buckets: Deque[Tuple[datetime, int]] = field(default_factory=deque)
+    window_count: int = 0
+    failures: int = 0
+    opened_until: Optional[datetime] = None
+    probing: bool = False
+    # Authoritative quota state from the provider's rate-limit response headers
+    remote_remaining: Optional[int] = None
+    remote_reset: Optional[datetime] = None
+    latency_ewma: Optional[float] = None  # Seeded by the first measured attempt
+    success_ewma: float = 1.0
+    # Invariant request parts, built once by FreeAIRouter._prepare_request_templates
+    key: str = ""
+    request_url: str = ""
+    auth_header: Dict[str, str] = field(default_factory=dict)
+    base_payload: Dict[str, Any] = field(default_factory=dict)
 
 
 class FreeAIRouter:
@@ -77,113 +217,614 @@ class FreeAIRouter:
                 rate_limit=None,
             ),
         }
-        self._check_daily_reset()
+        self._prepare_request_templates()
+        self._text_dispatch = {
+            "opencode_zen": self._call_opencode_zen,
+            "mistral": self._call_mistral,
+            "groq": self._call_groq_text,
+            "huggingface": self._call_huggingface,
+        }
+        self._vision_dispatch = {
+            "gemini": self._call_gemini_vision,
+            "groq": self._call_groq_vision,
+        }
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=TEXT_TIMEOUT,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        )
+        self.timeouts: Dict[str, httpx.Timeout] = {
+            "opencode_zen": TEXT_TIMEOUT,
+            "mistral": TEXT_TIMEOUT,
+            "groq": httpx.Timeout(connect=3.0, read=30.0, write=10.0, pool=1.0),
+            # Inference API cold-starts can take well over a minute
+            "huggingface": httpx.Timeout(connect=3.0, read=90.0, write=10.0, pool=1.0),
+        }
+        self.vision_timeouts: Dict[str, httpx.Timeout] = {
+            "gemini": httpx.Timeout(connect=3.0, read=45.0, write=15.0, pool=1.0),
+            "groq": VISION_TIMEOUT,
+        }
+        self._reset_task: Optional[asyncio.Task] = None
+        # Hedging can double quota spend on slow responses, so it is opt-in
+        self.hedging_enabled = os.getenv("AI_ROUTER_HEDGING", "false").lower() == "true"
+        # LRU of recent successful responses: key -> (expires_at monotonic, result)
+        self._cache: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Single-flight map so concurrent identical requests share one provider call
+        self._inflight: Dict[bytes, asyncio.Task] = {}
+        self.events: Deque[ProviderEvent] = deque(maxlen=METRICS_BUFFER_SIZE)
+        # Replace to forward events to Prometheus/StatsD; must not block
+        self.on_event: Callable[[ProviderEvent], None] = lambda event: None
+
+    def _prepare_request_templates(self):
+        for key, provider in self.providers.items():
+            provider.key = key
+            provider.request_url = provider.endpoint
+            if provider.api_key:
+                provider.auth_header = {
+                    "Authorization": f"Bearer {provider.api_key}",
+                    "Content-Type": "application/json"
+                }
+        
+        # Gemini authenticates via query string instead of a bearer token
+        gemini = self.providers["gemini"]
+        gemini.request_url = f"{gemini.endpoint}?key={gemini.api_key}"
+        gemini.auth_header = {"Content-Type": "application/json"}
+        
+        # Token caps and output format are per call; see GenerationOptions
+        self.providers["opencode_zen"].base_payload = {"model": self.providers["opencode_zen"].model, "temperature": 0.7}
+        self.providers["mistral"].base_payload = {"model": self.providers["mistral"].model, "temperature": 0.7}
+        # Groq's configured model is the vision one; text goes to the larger versatile model
+        self.providers["groq"].base_payload = {"model": "llama-3.1-70b-versatile", "temperature": 0.7}
+
+    def start(self):
+        """Start the background daily quota reset (needs a running event loop)"""
+        if self._reset_task is None:
+            self._reset_task = asyncio.create_task(self._daily_reset_loop())
 
-    def _check_daily_reset(self):
-        now = datetime.now()
-        for provider in self.providers.values():
-            if now.date() > provider.last_reset.date():
+    async def aclose(self):
+        if self._reset_task:
+            self._reset_task.cancel()
+            self._reset_task = None
+        await self._client.aclose()
+
+    async def _daily_reset_loop(self):
+        """Background task: zero all daily counters at local midnight"""
+        while True:
+            now = datetime.now()
+            tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            # Sleep against the monotonic clock so wall-clock jumps can't skip or repeat a reset
+            deadline = time.monotonic() + (tomorrow - now).total_seconds()
+            remaining = deadline - time.monotonic()
+            while remaining > 0:
+                await asyncio.sleep(remaining)
+                remaining = deadline - time.monotonic()
+            
+            now = datetime.now()
+            for provider in self.providers.values():
                 provider.requests_today = 0
                 provider.last_reset = now
+            logger.info("Daily provider quotas reset")
 
     def _can_use_provider(self, name: str) -> bool:
         provider = self.providers.get(name)
         if not provider or not provider.api_key:
             return False
-        if provider.rate_limit and provider.requests_today >= provider.rate_limit:
+        if provider.rate_limit and self._window_usage(provider) >= provider.rate_limit:
+            return False
+        if provider.remote_remaining == 0 and provider.remote_reset and datetime.now() < provider.remote_reset:
             return False
+        if provider.opened_until:
+            # Breaker open, or half-open with a probe already in flight
+            if datetime.now() < provider.opened_until or provider.probing:
+                return False
         return True
 
-    async def route_text(self, prompt: str, system: Optional[str] = None) -> Dict[str, Any]:
-        self._check_daily_reset()
-        text_providers = ["opencode_zen", "mistral", "groq", "huggingface"]
+    def _window_usage(self, provider: ProviderConfig) -> int:
+        cutoff = datetime.now() - RATE_WINDOW
+        buckets = provider.buckets
+        while buckets and buckets[0][0] <= cutoff:
+            provider.window_count -= buckets.popleft()[1]
+        return provider.window_count
+
+    def _record_usage(self, provider: ProviderConfig) -> datetime:
+        provider.requests_today += 1
+        minute = datetime.now().replace(second=0, microsecond=0)
+        if provider.buckets and provider.buckets[-1][0] == minute:
+            provider.buckets[-1] = (minute, provider.buckets[-1][1] + 1)
+        else:
+            provider.buckets.append((minute, 1))
+        provider.window_count += 1
+        return minute
+
+    def _reserve(self, name: str) -> Optional[datetime]:
+        """Check and charge quota in one step, before the call is awaited.
+
+        There is no await between the check and the increment, so concurrent
+        coroutines on the event loop cannot both take the last slot.
+        """
+        if not self._can_use_provider(name):
+            return None
+        return self._record_usage(self.providers[name])
+
+    def _refund(self, provider: ProviderConfig, minute: datetime):
+        provider.requests_today = max(0, provider.requests_today - 1)
+        for i in range(len(provider.buckets) - 1, -1, -1):
+            bucket_minute, count = provider.buckets[i]
+            if bucket_minute == minute:
+                provider.buckets[i] = (bucket_minute, count - 1)
+                provider.window_count -= 1
+                return
+            if bucket_minute < minute:
+                return
+
+    async def _call_reserved(self, name: str, make_call: Callable[[], Awaitable[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """Run make_call against reserved quota, refunding it unless the call succeeds"""
+        minute = self._reserve(name)
+        if minute is None:
+            return None
+        result = None
+        try:
+            result = await make_call()
+            return result
+        finally:
+            if result is None or not result["success"]:
+                self._refund(self.providers[name], minute)
+
+    def _record_latency(self, provider: ProviderConfig, elapsed: float):
+        if provider.latency_ewma is None:
+            provider.latency_ewma = elapsed
+        else:
+            provider.latency_ewma = (1 - EWMA_ALPHA) * provider.latency_ewma + EWMA_ALPHA * elapsed
+
+    def _record_outcome(self, provider: ProviderConfig, success: bool):
+        provider.success_ewma = (1 - EWMA_ALPHA) * provider.success_ewma + EWMA_ALPHA * (1.0 if success else 0.0)
+
+    def _ordered_providers(self, order: list) -> list:
+        """Sort by priority tier, then observed success rate and latency"""
+        def rank(name: str):
+            provider = self.providers[name]
+            tier = provider.priority + (1 if provider.success_ewma < EWMA_DEGRADED_SUCCESS else 0)
+            latency = provider.latency_ewma if provider.latency_ewma is not None else float("inf")
+            return (tier, -provider.success_ewma, latency)
+        return sorted(order, key=rank)
+
+    def _record_success(self, provider: ProviderConfig):
+        provider.failures = 0
+        provider.opened_until = None
+        provider.probing = False
+
+    def _record_failure(self, provider: ProviderConfig, exc: Exception):
+        provider.probing = False
+        if not _is_provider_fault(exc):
+            return
+        provider.failures += 1
+        if provider.failures >= BREAKER_FAILURE_THRESHOLD:
+            open_seconds = min(BREAKER_MAX_OPEN_SECONDS, 2 ** provider.failures)
+            provider.opened_until = datetime.now() + timedelta(seconds=open_seconds)
+            logger.warning(f"Circuit open for {provider.name} ({provider.failures} failures, {open_seconds}s)")
+
+    def _cache_key(self, task_type: str, prompt: str, system: Optional[str], options: GenerationOptions, image: Optional[bytes] = None) -> bytes:
+        h = hashlib.blake2b(
+            f"{task_type}\0{options.max_tokens}\0{options.json_mode:d}\0{system or ''}\0{prompt}".encode(),
+            digest_size=16
+        )
+        if image is not None:
+            h.update(b"\0")
+            h.update(image)
+        return h.digest()
+
+    def _cache_get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return dict(result)
+
+    def _cache_put(self, key: bytes, result: Dict[str, Any]):
+        self._cache[key] = (time.monotonic() + CACHE_TTL_SECONDS, dict(result))
+        self._cache.move_to_end(key)
+        while len(self._cache) > CACHE_MAXSIZE:
+            self._cache.popitem(last=False)
+
+    async def _route_cached(self, key: bytes, make_call: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Serve from cache, join an identical in-flight request, or run make_call"""
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
         
-        for provider_name in text_providers:
-            if not self._can_use_provider(provider_name):
+        # The shared call runs in its own task, so cancelling any one caller
+        # (including the first) never cancels or fails the others
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run_shared(key, make_call))
+            self._inflight[key] = task
+        return dict(await asyncio.shield(task))
+
+    async def _run_shared(self, key: bytes, make_call: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        try:
+            result = await make_call()
+            if result["success"]:
+                self._cache_put(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    async def route_text(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None, json_mode: bool = False) -> Dict[str, Any]:
+        options = GenerationOptions(max_tokens or DEFAULT_MAX_TOKENS, json_mode)
+        key = self._cache_key("text", prompt, system, options)
+        return await self._route_cached(key, lambda: self._route_text_chain(prompt, system, options))
+
+    async def _route_text_chain(self, prompt: str, system: Optional[str], options: GenerationOptions, skip: Tuple[str, ...] = ()) -> Dict[str, Any]:
+        for provider_name in self._ordered_providers(TEXT_PROVIDER_ORDER):
+            if provider_name in skip:
                 continue
                 
-            result = await self._call_text_provider(provider_name, prompt, system)
-            if result["success"]:
-                self.providers[provider_name].requests_today += 1
+            result = await self._call_reserved(
+                provider_name, lambda: self._call_text_provider(provider_name, prompt, system, options)
+            )
+            if result and result["success"]:
                 return result
         
         return {"success": False, "error": "All text providers failed or exhausted", "provider": None}
 
-    async def route_vision(self, image_base64: str, prompt: str, system: Optional[str] = None) -> Dict[str, Any]:
-        self._check_daily_reset()
-        vision_providers = ["gemini", "groq"]
+    async def route_text_many(self, prompts: List[str], system: Optional[str] = None, concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+                              max_tokens: Optional[int] = None, json_mode: bool = False) -> List[Dict[str, Any]]:
+        """Route a batch of prompts concurrently; results keep the order of prompts"""
+        # More in flight than pooled keep-alive connections would just open fresh sockets
+        semaphore = asyncio.Semaphore(max(1, min(concurrency, MAX_KEEPALIVE_CONNECTIONS)))
+        
+        async def worker(prompt: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.route_text(prompt, system, max_tokens, json_mode)
+        
+        return await asyncio.gather(*[worker(prompt) for prompt in prompts])
+
+    async def route_text_hedged(self, prompt: str, system: Optional[str] = None, hedge_after: float = 0.8,
+                                max_tokens: Optional[int] = None, json_mode: bool = False) -> Dict[str, Any]:
+        """Race the top two text providers, starting the backup after hedge_after seconds"""
+        candidates = [name for name in self._ordered_providers(TEXT_PROVIDER_ORDER) if self._can_use_provider(name)][:2]
+        if not self.hedging_enabled or len(candidates) < 2:
+            return await self.route_text(prompt, system, max_tokens, json_mode)
         
-        for provider_name in vision_providers:
+        primary, backup = candidates
+        options = GenerationOptions(max_tokens or DEFAULT_MAX_TOKENS, json_mode)
+        key = self._cache_key("text", prompt, system, options)
+        return await self._route_cached(
+            key, lambda: self._route_text_race(prompt, system, options, primary, backup, hedge_after)
+        )
+
+    async def _route_text_race(self, prompt: str, system: Optional[str], options: GenerationOptions,
+                               primary: str, backup: str, hedge_after: float) -> Dict[str, Any]:
+        pending = {asyncio.create_task(self._call_reserved(
+            primary, lambda: self._call_text_provider(primary, prompt, system, options)
+        ))}
+        backup_started = False
+        try:
+            while pending:
+                timeout = None if backup_started else hedge_after
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result and result["success"]:
+                        return result
+                if not backup_started:
+                    # Primary is slow or already failed; the cancelled loser gets its quota refunded
+                    pending.add(asyncio.create_task(self._call_reserved(
+                        backup, lambda: self._call_text_provider(backup, prompt, system, options)
+                    )))
+                    backup_started = True
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return await self._route_text_chain(prompt, system, options, skip=(primary, backup))
+
+    async def route_vision(self, image_base64: str, prompt: str, system: Optional[str] = None,
+                           max_tokens: Optional[int] = None, json_mode: bool = False) -> Dict[str, Any]:
+        """Route a vision request for a base64-encoded image; use route_vision_bytes for raw image bytes"""
+        if not isinstance(image_base64, str):
+            return {"success": False, "error": "image_base64 must be str; use route_vision_bytes for raw bytes", "provider": None}
+        try:
+            image = _clean_base64(image_base64.encode("ascii"))
+        except UnicodeEncodeError:
+            image = None
+        if image is None:
+            return {"success": False, "error": "image_base64 is not valid base64", "provider": None}
+        return await self._route_vision_encoded(image, prompt, system, max_tokens, json_mode)
+
+    async def route_vision_bytes(self, image: bytes, prompt: str, system: Optional[str] = None,
+                                 max_tokens: Optional[int] = None, json_mode: bool = False) -> Dict[str, Any]:
+        """Route a vision request for raw image bytes (encoded here, exactly once)"""
+        return await self._route_vision_encoded(base64.b64encode(image), prompt, system, max_tokens, json_mode)
+
+    async def _route_vision_encoded(self, image: bytes, prompt: str, system: Optional[str],
+                                    max_tokens: Optional[int], json_mode: bool) -> Dict[str, Any]:
+        # One ASCII byte buffer shared by the cache key and every provider body
+        options = GenerationOptions(max_tokens or DEFAULT_MAX_TOKENS, json_mode)
+        key = self._cache_key("vision", prompt, system, options, image)
+        return await self._route_cached(key, lambda: self._route_vision_chain(image, prompt, system, options))
+
+    async def _route_vision_chain(self, image: bytes, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
+        for provider_name in self._ordered_providers(VISION_PROVIDER_ORDER):
             provider = self.providers.get(provider_name)
             if not provider or provider.provider_type not in ["vision", "both"]:
                 continue
             if not self._can_use_provider(provider_name):
                 continue
                 
-            result = await self._call_vision_provider(provider_name, image_base64, prompt, system)
-            if result["success"]:
-                self.providers[provider_name].requests_today += 1
+            result = await self._call_reserved(
+                provider_name, lambda: self._call_vision_provider(provider_name, image, prompt, system, options)
+            )
+            if result and result["success"]:
                 return result
         
         return {"success": False, "error": "All vision providers failed or exhausted", "provider": None}
 
-    async def _call_text_provider(self, name: str, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def route_text_stream(self, prompt: str, system: Optional[str] = None,
+                                max_tokens: Optional[int] = None, json_mode: bool = False) -> AsyncIterator[str]:
+        """Yield response text as it arrives; fails over only until the first chunk is sent"""
+        options = GenerationOptions(max_tokens or DEFAULT_MAX_TOKENS, json_mode)
+        for provider_name in self._ordered_providers(TEXT_PROVIDER_ORDER):
+            provider = self.providers[provider_name]
+            
+            if provider_name not in STREAMING_PROVIDERS:
+                result = await self._call_reserved(
+                    provider_name, lambda: self._call_text_provider(provider_name, prompt, system, options)
+                )
+                if result and result["success"]:
+                    yield result["response"]
+                    return
+                continue
+            
+            minute = self._reserve(provider_name)
+            if minute is None:
+                continue
+            if provider.opened_until:
+                provider.probing = True
+            served = False
+            try:
+                # aclosing: if our consumer stops early, release the response and its pooled connection now
+                async with contextlib.aclosing(
+                    self._stream_openai_compatible(provider_name, provider, prompt, system, options)
+                ) as chunks:
+                    async for chunk in chunks:
+                        served = True
+                        yield chunk
+                served = True
+            except Exception as e:
+                logger.warning(f"Streaming provider {provider_name} failed: {e}")
+                if _is_provider_fault(e):
+                    self._record_outcome(provider, False)
+                self._record_failure(provider, e)
+                if served:
+                    raise
+                continue
+            finally:
+                provider.probing = False
+                # Even a partially streamed response was served (and billed) by the provider
+                if not served:
+                    self._refund(provider, minute)
+            
+            self._record_outcome(provider, True)
+            self._record_success(provider)
+            return
+        
+        raise RuntimeError("All text providers failed or exhausted")
+
+    async def _stream_openai_compatible(self, name: str, provider: ProviderConfig, prompt: str, system: Optional[str],
+                                        options: GenerationOptions) -> AsyncIterator[str]:
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": prompt})
+        body = orjson.dumps({**provider.base_payload, **options.openai_fields(), "messages": messages, "stream": True})
+        
+        t0 = time.perf_counter()
+        status: Union[int, str] = "cancelled"
+        bytes_in = 0
+        try:
+            async with self._client.stream(
+                "POST",
+                provider.request_url,
+                headers=provider.auth_header,
+                timeout=self.timeouts[name],
+                content=body
+            ) as response:
+                status = response.status_code
+                self._record_rate_limit_headers(provider, response)
+                response.raise_for_status()
+                try:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+                finally:
+                    bytes_in = response.num_bytes_downloaded
+        except Exception as e:
+            # A transport error before the headers, or a malformed SSE line after a 200
+            if not isinstance(status, int) or status < 400:
+                status = type(e).__name__
+            raise
+        finally:
+            self._emit_event(provider, status, time.perf_counter() - t0, bytes_in, len(body))
+
+    async def _call_text_provider(self, name: str, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
+        fn = self._text_dispatch.get(name)
+        if fn is None:
+            return {"success": False, "error": "Unknown provider", "provider": name}
         provider = self.providers[name]
+        if provider.opened_until:
+            provider.probing = True
         
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                if name == "opencode_zen":
-                    return await self._call_opencode_zen(client, provider, prompt, system)
-                elif name == "mistral":
-                    return await self._call_mistral(client, provider, prompt, system)
-                elif name == "groq":
-                    return await self._call_groq_text(client, provider, prompt, system)
-                elif name == "huggingface":
-                    return await self._call_huggingface(client, provider, prompt, system)
-                    
+            result = await fn(self._client, provider, prompt, system, options)
+            self._record_outcome(provider, True)
+            self._record_success(provider)
+            return result
+        except asyncio.CancelledError:
+            # Lost a hedged race; not a provider failure
+            provider.probing = False
+            raise
         except Exception as e:
             logger.warning(f"Provider {name} failed: {e}")
+            if _is_provider_fault(e):
+                self._record_outcome(provider, False)
+            self._record_failure(provider, e)
             return {"success": False, "error": str(e), "provider": name}
-        
-        return {"success": False, "error": "Unknown provider", "provider": name}
 
-    async def _call_vision_provider(self, name: str, image_base64: str, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_vision_provider(self, name: str, image: bytes, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
+        fn = self._vision_dispatch.get(name)
+        if fn is None:
+            return {"success": False, "error": "Unknown vision provider", "provider": name}
         provider = self.providers[name]
+        if provider.opened_until:
+            provider.probing = True
         
         try:
-            async with httpx.AsyncClient(timeout=90.0) as client:
-                if name == "gemini":
-                    return await self._call_gemini_vision(client, provider, image_base64, prompt, system)
-                elif name == "groq":
-                    return await self._call_groq_vision(client, provider, image_base64, prompt, system)
-                    
+            result = await fn(self._client, provider, image, prompt, system, options)
+            self._record_outcome(provider, True)
+            self._record_success(provider)
+            return result
+        except asyncio.CancelledError:
+            # Lost a hedged race; not a provider failure
+            provider.probing = False
+            raise
         except Exception as e:
             logger.warning(f"Vision provider {name} failed: {e}")
+            if _is_provider_fault(e):
+                self._record_outcome(provider, False)
+            self._record_failure(provider, e)
             return {"success": False, "error": str(e), "provider": name}
+
+    def _emit_event(self, provider: ProviderConfig, status: Union[int, str], elapsed: float, bytes_in: int, bytes_out: int):
+        # Per-attempt latency, so backoff sleeps never count against the provider;
+        # a cancelled attempt was cut short and says nothing about its speed
+        if status != "cancelled":
+            self._record_latency(provider, elapsed)
+        event = ProviderEvent(provider.key, status, elapsed, bytes_in, bytes_out)
+        self.events.append(event)
+        try:
+            self.on_event(event)
+        except Exception as e:
+            logger.warning(f"on_event hook failed: {e}")
+
+    def get_health_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per-provider call count, success rate and p50/p95 latency over the recent event buffer"""
+        latencies: Dict[str, List[float]] = {}
+        successes: Dict[str, int] = {}
+        cancelled: Dict[str, int] = {}
+        for event in self.events:
+            # Cut-short attempts (hedge losers, shutdown) are neither failures nor latency samples
+            if event.status == "cancelled":
+                cancelled[event.provider] = cancelled.get(event.provider, 0) + 1
+                continue
+            latencies.setdefault(event.provider, []).append(event.elapsed)
+            successes[event.provider] = successes.get(event.provider, 0) + event.success
         
-        return {"success": False, "error": "Unknown vision provider", "provider": name}
+        snapshot = {}
+        for name in {**latencies, **cancelled}:
+            samples = latencies.get(name, [])
+            if len(samples) > 1:
+                cuts = statistics.quantiles(samples, n=20, method="inclusive")
+                p50, p95 = cuts[9], cuts[18]
+            else:
+                p50 = p95 = samples[0] if samples else None
+            snapshot[name] = {
+                "calls": len(samples),
+                "cancelled": cancelled.get(name, 0),
+                "success_rate": successes[name] / len(samples) if samples else None,
+                "p50_latency": p50,
+                "p95_latency": p95,
+            }
+        return snapshot
 
-    async def _call_opencode_zen(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    def _record_rate_limit_headers(self, provider: ProviderConfig, response: httpx.Response) -> Optional[float]:
+        """Cache the provider's own quota headers; returns Retry-After in seconds"""
+        headers = response.headers
+        remaining = headers.get("x-ratelimit-remaining-requests") or headers.get("x-ratelimit-remaining")
+        if remaining is not None and remaining.isdigit():
+            provider.remote_remaining = int(remaining)
+            reset = _parse_seconds(headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset"))
+            provider.remote_reset = datetime.now() + timedelta(seconds=reset) if reset is not None else None
+        
+        retry_after = _parse_seconds(headers.get("retry-after"))
+        if response.status_code == 429 and retry_after is not None:
+            # Keep other requests off this provider until the server says it's ready
+            provider.opened_until = datetime.now() + timedelta(seconds=retry_after)
+        return retry_after
+
+    async def _retrying_post(self, client: httpx.AsyncClient, provider: ProviderConfig, method: str, url: str, **kwargs) -> httpx.Response:
+        """Retry transient failures with jittered backoff (LLM calls are safe to resend)"""
+        bytes_out = len(kwargs.get("content") or b"")
+        for attempt in range(MAX_RETRY_ATTEMPTS):
+            retry_after = None
+            t0 = time.perf_counter()
+            try:
+                try:
+                    response = await client.request(method, url, **kwargs)
+                except httpx.HTTPError as e:
+                    self._emit_event(provider, type(e).__name__, time.perf_counter() - t0, 0, bytes_out)
+                    raise
+                except asyncio.CancelledError:
+                    self._emit_event(provider, "cancelled", time.perf_counter() - t0, 0, bytes_out)
+                    raise
+                self._emit_event(provider, response.status_code, time.perf_counter() - t0, len(response.content), bytes_out)
+                retry_after = self._record_rate_limit_headers(provider, response)
+                response.raise_for_status()
+                return response
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRY_ATTEMPTS - 1:
+                    raise
+                # Not worth waiting out a long Retry-After here; fail over instead
+                if retry_after is not None and retry_after > MAX_RETRY_WAIT:
+                    raise
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                # Host unreachable or pool exhausted: the next provider is a
+                # better bet than sleeping and dialling the same one again
+                raise
+            except httpx.RemoteProtocolError:
+                if attempt == MAX_RETRY_ATTEMPTS - 1:
+                    raise
+                # Usually a pooled keep-alive socket the server already closed; redial at once
+                if attempt == 0:
+                    continue
+            except (httpx.ReadTimeout, httpx.WriteTimeout, httpx.ReadError, httpx.WriteError):
+                if attempt == MAX_RETRY_ATTEMPTS - 1:
+                    raise
+            
+            if retry_after is not None:
+                wait = retry_after
+            else:
+                wait = random.uniform(2, 4) * (attempt + 1)
+            wait = min(wait, MAX_RETRY_WAIT)
+            logger.info(f"Retrying {url.split('?')[0]} in {wait:.1f}s (attempt {attempt + 1}/{MAX_RETRY_ATTEMPTS})")
+            await asyncio.sleep(wait)
+
+    async def _call_opencode_zen(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         messages = []
         if system:
             messages.append({"role": "system", "content": system})
         messages.append({"role": "user", "content": prompt})
         
-        response = await client.post(
-            provider.endpoint,
-            headers={
-                "Authorization": f"Bearer {provider.api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": provider.model,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.timeouts["opencode_zen"],
+            content=orjson.dumps({**provider.base_payload, **options.openai_fields(), "messages": messages})
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
@@ -192,24 +833,22 @@ class FreeAIRouter:
             "model": provider.model
         }
 
-    async def _call_mistral(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_mistral(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         messages = []
         if system:
             messages.append({"role": "system", "content": system})
         messages.append({"role": "user", "content": prompt})
         
-        response = await client.post(
-            provider.endpoint,
-            headers={"Authorization": f"Bearer {provider.api_key}"},
-            json={
-                "model": provider.model,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.timeouts["mistral"],
+            content=orjson.dumps({**provider.base_payload, **options.openai_fields(), "messages": messages})
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
@@ -218,49 +857,46 @@ class FreeAIRouter:
             "model": provider.model
         }
 
-    async def _call_groq_text(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_groq_text(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         messages = []
         if system:
             messages.append({"role": "system", "content": system})
         messages.append({"role": "user", "content": prompt})
         
-        response = await client.post(
-            provider.endpoint,
-            headers={"Authorization": f"Bearer {provider.api_key}"},
-            json={
-                "model": "llama-3.1-70b-versatile",
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.timeouts["groq"],
+            content=orjson.dumps({**provider.base_payload, **options.openai_fields(), "messages": messages})
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
             "response": data["choices"][0]["message"]["content"],
             "provider": "groq",
-            "model": "llama-3.1-70b-versatile"
+            "model": provider.base_payload["model"]
         }
 
-    async def _call_huggingface(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_huggingface(self, client: httpx.AsyncClient, provider: ProviderConfig, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         full_prompt = f"{system}\n\nUser: {prompt}\n\nAssistant:" if system else f"User: {prompt}\n\nAssistant:"
         
-        response = await client.post(
-            provider.endpoint,
-            headers={"Authorization": f"Bearer {provider.api_key}"},
-            json={
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.timeouts["huggingface"],
+            content=orjson.dumps({
                 "inputs": full_prompt,
-                "parameters": {
-                    "max_new_tokens": 500,
-                    "temperature": 0.7,
-                    "return_full_text": False
-                }
-            }
+                "parameters": {"max_new_tokens": options.max_tokens, "temperature": 0.7, "return_full_text": False}
+            })
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
@@ -269,25 +905,26 @@ class FreeAIRouter:
             "model": "Mistral-7B-Instruct"
         }
 
-    async def _call_gemini_vision(self, client: httpx.AsyncClient, provider: ProviderConfig, image_base64: str, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_gemini_vision(self, client: httpx.AsyncClient, provider: ProviderConfig, image: bytes, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         parts = []
         if system:
             parts.append({"text": system})
         parts.append({"text": prompt})
-        parts.append({"inline_data": {"mime_type": "image/png", "data": image_base64}})
+        parts.append({"inline_data": {"mime_type": "image/png", "data": IMAGE_PLACEHOLDER}})
         
-        response = await client.post(
-            f"{provider.endpoint}?key={provider.api_key}",
-            json={
-                "contents": [{"parts": parts}],
-                "generationConfig": {
-                    "temperature": 0.3,
-                    "maxOutputTokens": 2000
-                }
-            }
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.vision_timeouts["gemini"],
+            content=_splice_image({
+                "generationConfig": options.gemini_generation_config(),
+                "contents": [{"parts": parts}]
+            }, image)
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
@@ -296,7 +933,7 @@ class FreeAIRouter:
             "model": "gemini-2.0-flash"
         }
 
-    async def _call_groq_vision(self, client: httpx.AsyncClient, provider: ProviderConfig, image_base64: str, prompt: str, system: Optional[str]) -> Dict[str, Any]:
+    async def _call_groq_vision(self, client: httpx.AsyncClient, provider: ProviderConfig, image: bytes, prompt: str, system: Optional[str], options: GenerationOptions) -> Dict[str, Any]:
         messages = []
         if system:
             messages.append({"role": "system", "content": system})
@@ -304,22 +941,25 @@ class FreeAIRouter:
             "role": "user",
             "content": [
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+                {"type": "image_url", "image_url": {"url": IMAGE_PLACEHOLDER}}
             ]
         })
         
-        response = await client.post(
-            provider.endpoint,
-            headers={"Authorization": f"Bearer {provider.api_key}"},
-            json={
+        response = await self._retrying_post(
+            client,
+            provider,
+            "POST",
+            provider.request_url,
+            headers=provider.auth_header,
+            timeout=self.vision_timeouts["groq"],
+            content=_splice_image({
                 "model": provider.model,
-                "messages": messages,
                 "temperature": 0.3,
-                "max_tokens": 2000
-            }
+                **options.openai_fields(),
+                "messages": messages
+            }, image, prefix=b"data:image/png;base64,")
         )
-        response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         return {
             "success": True,
@@ -329,7 +969,6 @@ class FreeAIRouter:
         }
 
     def get_quota_status(self) -> Dict[str, Dict[str, Any]]:
-        self._check_daily_reset()
         return {
             name: {
                 "name": p.name,
@@ -337,19 +976,15 @@ class FreeAIRouter:
                 "type": p.provider_type,
                 "requests_today": p.requests_today,
                 "rate_limit": p.rate_limit,
-                "remaining": (p.rate_limit - p.requests_today) if p.rate_limit else "unlimited",
+                "remaining": (p.rate_limit - self._window_usage(p)) if p.rate_limit else "unlimited",
+                "remote_remaining": p.remote_remaining,
                 "available": self._can_use_provider(name)
             }
             for name, p in self.providers.items()
         }
 
     def get_recommended_provider(self, task_type: Literal["text", "vision"]) -> Optional[str]:
-        self._check_daily_reset()
-        
-        if task_type == "text":
-            order = ["opencode_zen", "mistral", "groq", "huggingface"]
-        else:
-            order = ["gemini", "groq"]
+        order = self._ordered_providers(TEXT_PROVIDER_ORDER if task_type == "text" else VISION_PROVIDER_ORDER)
         
         for name in order:
             if self._can_use_provider(name):